@@ -58,7 +58,7 @@ class TransformerAggregator(Aggregator):
         if node_mask is None:
             return self.encoder(data).mean(1, keepdim=True)
         else:
-            mask = node_mask @ node_mask.transpose(-2, -1)
+            mask = node_mask & node_mask.transpose(-2, -1)
             N_real = node_mask.sum(-2).unsqueeze(-1) + 1e-9  # [B..., 1, 1]
 
             embeddings = self.encoder(data, mask) * node_mask
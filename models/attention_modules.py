@@ -19,6 +19,10 @@ import torch.nn.functional as F
 from einops import rearrange, repeat
 import math
 
+# FlashAttention-backed fused attention (torch >= 2.0); fall back to the
+# explicit implementation on older builds.
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 class GEGLU(nn.Module):
     def forward(self, x):
@@ -130,8 +134,7 @@ class Attention(nn.Module):
         self.nhead = nhead
 
         self.to_q = nn.Linear(d_model, inner_dim, bias=False)
-        self.to_k = nn.Linear(d_model, inner_dim, bias=False)
-        self.to_v = nn.Linear(d_model, inner_dim, bias=False)
+        self.to_kv = nn.Linear(d_model, inner_dim * 2, bias=False)
 
         self.dropout = nn.Dropout(dropout)
         self.to_out = nn.Linear(inner_dim, d_model)
@@ -140,9 +143,41 @@ class Attention(nn.Module):
 
         h = self.nhead
 
-        q = self.to_q(query)  
-        k = self.to_k(key)  
-        v = self.to_v(value)
+        q = self.to_q(query)
+        if key is value:
+            # Key and value always share their input here, so one fused GEMM
+            # replaces the two separate projections.
+            k, v = self.to_kv(key).chunk(2, dim=-1)
+        else:
+            w_k, w_v = self.to_kv.weight.chunk(2, dim=0)
+            k = F.linear(key, w_k)
+            v = F.linear(value, w_v)
+
+        if _HAS_SDPA and not return_info:
+            # Fused kernel path; dispatches to FlashAttention on supported
+            # CUDA dtypes. Only usable when the attention weights themselves
+            # are not requested.
+            qu, ku, vu = map(
+                lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v)
+            )
+            attn_mask = (
+                src_mask.bool().unsqueeze(1) if src_mask is not None else None
+            )  # [B, 1, 1 or M, N] broadcasts over heads
+            if attn_mask is not None:
+                # SDPA returns NaN for fully-masked rows (the aggregator
+                # produces one per padding node); re-enable such rows so they
+                # get the uniform attention the finite masked_fill gave, and
+                # leave it to the caller to zero them out.
+                attn_mask = attn_mask | ~attn_mask.any(-1, keepdim=True)
+            out = F.scaled_dot_product_attention(
+                qu,
+                ku,
+                vu,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            out = rearrange(out, "b h n d -> b n (h d)")
+            return self.to_out(out)
 
         qu, ku, vu = map(
             lambda t: rearrange(t, "b n (h d) -> (b h) n d", h=h), (q, k, v)
@@ -9,7 +9,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import numpy as np
 from models.attention_modules import *
 import math
 from models.aggregator_modules import TransformerAggregator
@@ -20,6 +19,7 @@ from models.aggregator_modules import TransformerAggregator
 class Memory(nn.Module):
     def __init__(self):
         super(Memory, self).__init__()
+        self._graph_cache = {}  # query shape -> (graph, static_query, static_out)
 
     def retrieve(self, x):
         """
@@ -30,6 +30,63 @@ class Memory(nn.Module):
         """
         raise NotImplementedError
 
+    def invalidate_graphs(self):
+        # Captured graphs replay against the context tensors that were live at
+        # capture time, so they must be dropped whenever the memory content
+        # changes (setup_data / reset).
+        self._graph_cache = {}
+
+    def graph_retrieve(self, query_data):
+        """
+        CUDA-graph-replayed retrieve() for the repeated fixed-shape eval path.
+
+        Retrieval launches many small kernels with identical shapes between
+        setup_data calls; capturing them once and replaying removes the
+        per-call Python and launch overhead. Falls back to plain retrieve()
+        in training mode or off-CUDA. Graphs are keyed by query shape and
+        invalidated whenever the underlying context data changes.
+
+        Arguments:
+            query_data: [B, M, D] Tensor
+        Returns:
+            ret: [B, M, D] Tensor
+        """
+        if self.training or not query_data.is_cuda:
+            return self.retrieve(query_data)
+
+        key = tuple(query_data.shape)
+        entry = self._graph_cache.get(key)
+        if entry is None:
+            static_query = query_data.clone()
+            # Graph capture of autocast regions (VanillaMemory.retrieve)
+            # requires the autocast weight cache to be off; cached casts
+            # recorded during capture are freed when the context exits and
+            # would corrupt replays.
+            autocast_cache_enabled = torch.is_autocast_cache_enabled()
+            torch.set_autocast_cache_enabled(False)
+            try:
+                with torch.no_grad():
+                    # Warm up on a side stream before capture
+                    stream = torch.cuda.Stream()
+                    stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(stream):
+                        for _ in range(3):
+                            self.retrieve(static_query)
+                    torch.cuda.current_stream().wait_stream(stream)
+
+                    graph = torch.cuda.CUDAGraph()
+                    with torch.cuda.graph(graph):
+                        static_out = self.retrieve(static_query)
+            finally:
+                torch.set_autocast_cache_enabled(autocast_cache_enabled)
+            entry = (graph, static_query, static_out)
+            self._graph_cache[key] = entry
+
+        graph, static_query, static_out = entry
+        static_query.copy_(query_data)
+        graph.replay()
+        return static_out.clone()
+
 
 class VanillaMemory(Memory):
     def __init__(self, d_model, nhead, dim_feedforward, dropout, norm_first):
@@ -48,11 +105,15 @@ class VanillaMemory(Memory):
             d_model, FeedForward(d_model, dim_feedforward, dropout)
         )
 
+        self.autocast_dtype = torch.bfloat16
+
     def setup_data(self, layer_data):
         self.layer_data = layer_data
+        self.invalidate_graphs()
 
     def reset(self):
         self.layer_data = None
+        self.invalidate_graphs()
 
     def retrieve(self, query_data):
         """
@@ -61,10 +122,15 @@ class VanillaMemory(Memory):
         Returns:
             ret: [B, M, D] Tensor
         """
-        ca_output = self.cross_attention(
-            query_data, key=self.layer_data, value=self.layer_data
-        )
-        ca_ff_output = self.cross_attention_ff(ca_output)
+        # Mixed precision halves the bytes moved by the memory-bound cross
+        # attention; losses outside this block stay in fp32.
+        with torch.autocast(
+            "cuda", dtype=self.autocast_dtype, enabled=query_data.is_cuda
+        ):
+            ca_output = self.cross_attention(
+                query_data, key=self.layer_data, value=self.layer_data
+            )
+            ca_ff_output = self.cross_attention_ff(ca_output)
         return ca_ff_output
 
 
@@ -92,10 +158,15 @@ class TreeMemory(Memory):
 
         # Check Notes for implementation
         self.branch_factor = branch_factor
+        self._log_bf = math.log(branch_factor)
 
-        self.train_tree_data = ( # List representation of the tree
-            [] # To be filled with type: (layer_data, layer_mask)
-        )  
+        # Per-level representation of the tree, stored root-first:
+        # _level_data[0] is the root [B, D], _level_data[-1] the leaves.
+        self._level_data = []
+        self._level_mask = []
+
+        # Reused no-op RL terms; registered so it follows the model's device
+        self.register_buffer("_zero_scalar", torch.zeros(()))
 
         if aggregator_type == "transformer":
             # Used to order the datapoints.
@@ -121,43 +192,46 @@ class TreeMemory(Memory):
             FeedForward(d_model, dim_feedforward=dim_feedforward, dropout=dropout),
         )
 
+        # Compile the per-level aggregation body so the mask reductions fuse
+        # with the aggregator ops (no-op on torch builds without compile).
+        self._aggregate_level_fn = (
+            torch.compile(self._aggregate_level, dynamic=True)
+            if hasattr(torch, "compile")
+            else self._aggregate_level
+        )
+
 
     def setup_data(self, layer_data):
         self.tree_generator(layer_data)
+        self.invalidate_graphs()
 
     def reset(self):
-        del self.train_tree_data
-        self.train_tree_data = []
+        self._level_data = []
+        self._level_mask = []
+        self._leaf_data_flat = None
+        self._leaf_mask_flat = None
+        self.invalidate_graphs()
 
-    def pad_node_data(self, node_data):
+    def pad_node_data(self, node_data, k, P):
         # Pad node data to make it easily handleable
 
         device = node_data.device
         B, N, D = node_data.shape
 
-        k = (
-            torch.floor(
-                torch.log(torch.tensor(N - 1))
-                / torch.log(torch.tensor(self.branch_factor))
-            )
-            .int()
-            .item()
-        )
-        P = math.ceil(N / self.branch_factor**k)
-
         num_pad_nodes = (
             P * (self.branch_factor**k) - N
         )
 
-        tree_data = torch.zeros(B, N + num_pad_nodes, D).to(device) 
-        tree_data[:, :N, :] = node_data
-        tree_data[:, N:, :] = (
-            node_data[:, :num_pad_nodes, :] + 1e-5
+        tree_data = torch.cat(
+            [node_data, node_data[:, :num_pad_nodes, :] + 1e-5], dim=1
         )  # Pad with real data and some buffer to relatively evenly split the data
-        mask = torch.zeros(tree_data.shape[:-1], device=device).unsqueeze(
-            -1
+        mask = torch.cat(
+            [
+                torch.ones(B, N, 1, dtype=torch.bool, device=device),  # Real data
+                torch.zeros(B, num_pad_nodes, 1, dtype=torch.bool, device=device),
+            ],
+            dim=1,
         )  # [B, N', 1]
-        mask[:, :N, :] = 1  # Real data
         return tree_data, mask
 
     def tree_generator(self, node_data):
@@ -168,64 +242,78 @@ class TreeMemory(Memory):
         # Example 2: Indexing according to [1][1][0][0] refers to the leaf achieved by going right, right, left, left down the tree.
 
         B, N, D = node_data.shape
-        k = (
-            torch.floor(
-                torch.log(torch.tensor(N - 1))
-                / torch.log(torch.tensor(self.branch_factor))
-            )
-            .int()
-            .item()
-        )  
+        k = int(math.log(N - 1) / self._log_bf)
         P = math.ceil(N / self.branch_factor**k)
 
+        # Cache the shape constants so the bottom-up pass does not recompute
+        # them per level (leaves first, then one entry per tree depth).
+        self._branch_shape = (self.branch_factor,) * k
+        self._level_batch_sizes = [B * self.branch_factor**k] + [
+            B * self.branch_factor**i for i in range(k - 1, -1, -1)
+        ]
+
         tree_depth_data, tree_depth_mask = self.pad_node_data(
-            node_data
+            node_data, k, P
         )  # Pad the data to an easily organizable size
 
         tree_depth_data = tree_depth_data.reshape(
-            B, *([self.branch_factor] * k), P, D
+            B, *self._branch_shape, P, D
         )  # Construct the leaves
-        tree_depth_mask = tree_depth_mask.reshape(B, *([self.branch_factor] * k), P, 1)
+        tree_depth_mask = tree_depth_mask.reshape(B, *self._branch_shape, P, 1)
 
         self.bottom_up_aggregation(tree_depth_data, tree_depth_mask)
 
     def bottom_up_aggregation(self, tree_depth_data, tree_depth_mask):
         D = tree_depth_data.shape[-1]
         # tree_depth_data: [B, b, b, ..., b, P, D], tree_depth_mask: [B, b, b, ..., b, P, 1]
-        self.train_tree_data = [(tree_depth_data, tree_depth_mask.detach())]
-
-        # Perform the bottom-up aggregation
-        while len(tree_depth_data.shape) > 2:  # Stops at [B, D]
-            tmp_batch_size = np.prod(tree_depth_data.shape[:-2])
+        num_levels = len(self._level_batch_sizes) + 1
+        self._level_data = [None] * num_levels
+        self._level_mask = [None] * num_levels
+        self._level_data[-1] = tree_depth_data
+        self._level_mask[-1] = tree_depth_mask.detach()
+
+        # Flattened leaf views for tree_leaves_retrieval, computed once per
+        # tree build rather than on every retrieval call
+        self._leaf_data_flat = tree_depth_data.flatten(1, -2)  # [B, L, D]
+        self._leaf_mask_flat = (
+            self._level_mask[-1].flatten(1, -2).transpose(1, 2)
+        )  # [B, 1, L]
+
+        # Perform the bottom-up aggregation (stops at the [B, D] root)
+        for depth, tmp_batch_size in enumerate(self._level_batch_sizes):
             branch_size = tree_depth_data.shape[-2]
 
-            tmp_tree_depth_data = tree_depth_data.reshape(
+            tmp_tree_depth_data = tree_depth_data.view(
                 (tmp_batch_size, branch_size, D)
             )
-            tmp_tree_depth_mask = tree_depth_mask.reshape(
+            tmp_tree_depth_mask = tree_depth_mask.view(
                 (tmp_batch_size, branch_size, 1)
             )
 
-            computed_tree_depth_data = self.aggregator(
-                tmp_tree_depth_data, tmp_tree_depth_mask
-            ).squeeze(
-                -2
-            )  # [B..., D]
-
-            computed_tree_depth_mask = tmp_tree_depth_mask.any(
-                dim=-2
-            ).float()  # if any of its children are not padding nodes, then it is not a padding node
+            computed_tree_depth_data, computed_tree_depth_mask = (
+                self._aggregate_level_fn(tmp_tree_depth_data, tmp_tree_depth_mask)
+            )
 
-            tree_depth_data = computed_tree_depth_data.reshape(
+            tree_depth_data = computed_tree_depth_data.view(
                 (*(tree_depth_data.shape[:-2]), tree_depth_data.shape[-1])
             )  # [B, b, ..., b, D]
-            tree_depth_mask = computed_tree_depth_mask.reshape(
+            tree_depth_mask = computed_tree_depth_mask.view(
                 (*(tree_depth_mask.shape[:-2]), tree_depth_mask.shape[-1])
             )  # [B, b, ..., b, 1]
 
-            self.train_tree_data.append((tree_depth_data, tree_depth_mask.detach()))
+            self._level_data[num_levels - 2 - depth] = tree_depth_data
+            self._level_mask[num_levels - 2 - depth] = tree_depth_mask.detach()
 
-        self.train_tree_data = list(reversed(self.train_tree_data))
+    def _aggregate_level(self, tmp_tree_depth_data, tmp_tree_depth_mask):
+        # One bottom-up level: aggregate each node's children and mark the
+        # node as padding only if all of its children are padding nodes.
+        computed_tree_depth_data = self.aggregator(
+            tmp_tree_depth_data, tmp_tree_depth_mask
+        ).squeeze(
+            -2
+        )  # [B..., D]
+        computed_tree_depth_mask = tmp_tree_depth_mask.any(dim=-2)
+        return computed_tree_depth_data, computed_tree_depth_mask
 
     def retrieve(self, query_data):
         entropy_att_scores_list = []
@@ -260,9 +348,9 @@ class TreeMemory(Memory):
         batch_size, nQueries = query_data.shape[0], query_data.shape[1]
         B = batch_size
         M = nQueries
-        D = self.train_tree_data[0][0].shape[-1]
+        D = self._level_data[0].shape[-1]
 
-        filtered_tree_data = self.train_tree_data[1:]
+        num_search_levels = len(self._level_data) - 1  # all levels below the root
         flattened_query_data = query_data.flatten(0, 1).unsqueeze(1)  # [B*M, 1, D]
 
         entropy_att_scores_list = []
@@ -270,8 +358,9 @@ class TreeMemory(Memory):
         selected_data_embeddings = [] # Array of [B*M, 1, D] (Stores selected nodes)
         selected_data_masks = [] # Array of [B*M, 1, 1] (Stores selected nodes' mask)
         
-        for i in range(len(filtered_tree_data)):
-            (layer_data_embeddings, layer_data_mask) = filtered_tree_data[i]
+        for i in range(num_search_levels):
+            layer_data_embeddings = self._level_data[i + 1]
+            layer_data_mask = self._level_mask[i + 1]
             if i == 0:
                 # Root Node
                 layer_data_embeddings = repeat(layer_data_embeddings, 'B b d -> B M b d', M = M)
@@ -309,7 +398,7 @@ class TreeMemory(Memory):
                 layer_data_mask = rearrange(layer_data_mask, 'B a c D -> B (a c) D')
                 # [B, b, 1]
 
-                if i == len(filtered_tree_data) - 1:
+                if i == num_search_levels - 1:
                     selected_data_embeddings.append(layer_data_embeddings)
                     selected_data_masks.append(layer_data_mask)
                     break
@@ -334,26 +423,32 @@ class TreeMemory(Memory):
                 
             # Select the next node to expand
             if self.training:
-                # Stochastic selection
-                selected_indices = torch.multinomial(level_search_att_weight_mean_nodes.flatten(0, 1), 1)
+                # Stochastic selection via Gumbel-argmax (same distribution as
+                # multinomial sampling, but only elementwise ops + argmax).
+                # No epsilon on the probabilities: zero-weight (masked)
+                # children must keep a -inf logit so they can never win the
+                # argmax, matching multinomial.
+                branch_probs = level_search_att_weight_mean_nodes.flatten(0, 1)
+                gumbel_noise = -torch.log(
+                    -torch.log(torch.rand_like(branch_probs) + 1e-9) + 1e-9
+                )
+                selected_indices = (torch.log(branch_probs) + gumbel_noise).argmax(-1, keepdim=True)
             else:  
                 # Greedily (deterministically) select the nodes to expand
                 selected_indices = level_search_att_weight_mean_nodes.flatten(0, 1).max(-1)[1].unsqueeze(-1)
 
-            # Compute the mask for the selected/rejected nodes 
-            tree_search_level_embeddings = layer_data_embeddings.reshape(B*M, N_i, D)
-            tree_search_level_mask = (1 - F.one_hot(selected_indices, num_classes = N_i)).reshape(B*M, N_i, 1)
+            # Compute the mask for the selected/rejected nodes
+            tree_search_level_embeddings = layer_data_embeddings  # [B*M, N_i, D]
+            tree_search_level_mask = (F.one_hot(selected_indices, num_classes = N_i) == 0).reshape(B*M, N_i, 1)
 
             # Add the level's node embeddings and mask
             selected_data_embeddings.append(tree_search_level_embeddings) # Add to "S"
             selected_data_masks.append(tree_search_level_mask)
 
             # Compute next tree layer indices
-            next_layer_data_indices = layer_data_indices[
-                torch.arange(B * M, device="cuda"), selected_indices.flatten()
-            ].reshape(
-                B * M, 1
-            )
+            next_layer_data_indices = layer_data_indices.gather(
+                1, selected_indices
+            )  # [B*M, 1]
 
             # Compute additional terms for training
             if self.training:
@@ -361,42 +456,21 @@ class TreeMemory(Memory):
                 entropy_att_scores_list.append(
                     (-search_att_weight * torch.log(search_att_weight + 1e-9)).sum(-1)
                 ) 
-                # Compute action log probabilities
-                log_branch_sel_prob = torch.log(level_search_att_weight_mean_nodes.squeeze(1)[
-                        torch.arange(B * M, device="cuda"), selected_indices.flatten()
-                    ].squeeze(-1))
+                # Compute action log probabilities (clamped so an
+                # underflowed selection probability cannot yield -inf)
+                log_branch_sel_prob = (
+                    level_search_att_weight_mean_nodes.squeeze(1)
+                    .gather(1, selected_indices)
+                    .squeeze(-1)
+                    .clamp_min(1e-9)
+                    .log()
+                )
                 log_branch_sel_prob_list.append(log_branch_sel_prob)
 
         # Aggregate the selected nodes
         search_data_embeddings = torch.cat(selected_data_embeddings, dim=1)
         search_data_masks = torch.cat(selected_data_masks, dim=1).transpose(1, 2)
 
-        # manuell set to true
-        if False:
-            # Reshape to [B, M, x, D]
-            reshaped_tensor = rearrange(search_data_embeddings, "(B M) x D -> B M x D", M=M)
-            reshaped_tensor = reshaped_tensor.reshape(B, M, -1)  # Flatten x and D for simplicity
-            diffs = torch.zeros(M, M, reshaped_tensor.shape[-1], device="cuda")
-
-            for b in range(1):
-                # Pairwise differences for all (i, j)
-                # -> [M, x*D]
-                for i in range(M):
-                    for j in range(M):
-                        diffs[i, j] = reshaped_tensor[b][i] - reshaped_tensor[b][j]
-
-                # Compute closeness using torch.isclose
-                is_close = torch.isclose(diffs, torch.zeros_like(diffs))  # Element-wise closeness
-                ratios = is_close.all(dim=-1).float()  # all close along x*D
-            
-                max_val = ratios.max().item()
-                min_val = ratios.min().item()
-                mean_val = ratios.mean().item()
-                median_val = ratios.median().item()
-                redundancy_count = ((ratios == 1.0).sum().item() - M) / 2
-
-                print(f"Batch {b} | Max: {max_val} | Min: {min_val} | Mean: {mean_val} | Median: {median_val} | Red: {redundancy_count}")
-                    
         # Using the aggregated nodes, compute the final embedding
         # pred_emb_pre_out: [B*M, 1, D], flattened_query_Data:[B*M, 1, D], search_data_embeddings: [B*M, N_i, D], search_masks: [B*M, 1, N_i]
         pred_emb = self.query_model(
@@ -413,11 +487,10 @@ class TreeMemory(Memory):
         return pred_emb, entropy_att_scores_list, log_branch_sel_prob_list
 
     def tree_leaves_retrieval(self, query_data):
-        M = query_data.shape[1]
         # For computing L_{TCA}
-        leaf_data_embeddings, leaf_data_mask = self.train_tree_data[-1]
-        leaf_data_embeddings = leaf_data_embeddings.flatten(1, -2)
-        leaf_data_mask = leaf_data_mask.flatten(1, -2).transpose(1, 2).repeat(1, M, 1)
+        leaf_data_embeddings = self._leaf_data_flat
+        # [B, 1, L]; broadcasts over the M queries inside the attention
+        leaf_data_mask = self._leaf_mask_flat
         leaf_pred_emb = self.query_model(
             query_data,
             key=leaf_data_embeddings,
@@ -433,11 +506,11 @@ class TreeMemory(Memory):
             entropy_scores = torch.stack(entropy_att_scores_list, dim=2)
             entropy_scores = entropy_scores.mean()
         else:
-            entropy_scores = torch.tensor(0.0).cuda()
+            entropy_scores = self._zero_scalar
 
         if len(log_branch_sel_prob_list) > 0:
             log_action_probs = torch.stack(log_branch_sel_prob_list, dim=-1)
             log_action_probs = log_action_probs.sum(-1)
         else:
-            log_action_probs = torch.tensor(0.0).cuda()
+            log_action_probs = self._zero_scalar
         return entropy_scores, log_action_probs
@@ -192,7 +192,7 @@ class Retreever(nn.Module):
 
             sorted_ftx_idxs = torch.argsort(xc_values).reshape(-1)
             batch_idxs = (
-                torch.arange(xc.shape[0], device="cuda")
+                torch.arange(xc.shape[0], device=xc.device)
                 .repeat_interleave(xc.shape[1])
                 .reshape(-1)
             )
@@ -207,7 +207,7 @@ class Retreever(nn.Module):
 
             sorted_ftx_idxs = torch.argsort(xc_values).reshape(-1)
             batch_idxs = (
-                torch.arange(xc.shape[0], device="cuda")
+                torch.arange(xc.shape[0], device=xc.device)
                 .repeat_interleave(xc.shape[1])
                 .reshape(-1)
             )
@@ -221,7 +221,7 @@ class Retreever(nn.Module):
 
             sorted_ftx_idxs = torch.argsort(xc_data_proj.squeeze(-1)).reshape(-1)
             batch_idxs = (
-                torch.arange(xc.shape[0], device="cuda")
+                torch.arange(xc.shape[0], device=xc.device)
                 .repeat_interleave(xc.shape[1])
                 .reshape(-1)
             )
@@ -327,15 +327,13 @@ class Retreever(nn.Module):
             tar_ll = prediction.log_prob(yt).sum(-1)
             outs.tar_ll = tar_ll.mean()
             loss_value = -outs.tar_ll
-        elif self.loss == "mse": 
-            loss = nn.MSELoss(reduction="none")
-            outs.mse = loss(prediction, yt).mean()
+        elif self.loss == "mse":
+            outs.mse = F.mse_loss(prediction, yt)
             loss_value = outs.mse
         elif self.loss == "ce":
-            loss = nn.CrossEntropyLoss(reduction="none")
-            outs.ce = loss(
+            outs.ce = F.cross_entropy(
                 prediction.flatten(0, -2), yt.max(-1)[-1].flatten(0, -1)
-            ).mean()
+            )
             outs.acc = (
                 (prediction.flatten(0, -2).max(-1)[1] == yt.max(-1)[-1].flatten(0, -1))
                 .float()
@@ -356,14 +354,12 @@ class Retreever(nn.Module):
     ):  # $\mathcal{L}_{CA}$ loss term
         if self.loss == "nll":
             outs.tca_leaf_loss = -tca_leaf_prediction.log_prob(level_yt).sum(-1).mean()
-        elif self.loss == "mse": 
-            loss = nn.MSELoss(reduction="none")
-            outs.tca_leaf_loss = loss(tca_leaf_prediction, level_yt).mean()
+        elif self.loss == "mse":
+            outs.tca_leaf_loss = F.mse_loss(tca_leaf_prediction, level_yt)
         elif self.loss == "ce":
-            loss = nn.CrossEntropyLoss(reduction="none")
-            outs.tca_leaf_loss = loss(
+            outs.tca_leaf_loss = F.cross_entropy(
                 tca_leaf_prediction.flatten(0, -2), level_yt.max(-1)[-1].flatten(0, -1)
-            ).mean()
+            )
         else:
             raise NotImplementedError
 
@@ -376,15 +372,17 @@ class Retreever(nn.Module):
             tca_tar_ll = prediction.log_prob(yt).sum(-1)
             rl_rew = tca_tar_ll.detach().flatten()
             baseline_value = 0.0
-        elif self.loss == "mse": 
-            loss = nn.MSELoss(reduction="none")
-            tca_mse = loss(prediction, yt)
+        elif self.loss == "mse":
+            tca_mse = F.mse_loss(prediction, yt, reduction="none")
             rl_rew = -tca_mse.detach()
             baseline_value = 0.0
         elif self.loss == "ce":
             if self.classification_rew_type == "nce":
-                loss = nn.CrossEntropyLoss(reduction="none")
-                tca_ce = loss(prediction.flatten(0, -2), yt.max(-1)[-1].flatten(0, -1))
+                tca_ce = F.cross_entropy(
+                    prediction.flatten(0, -2),
+                    yt.max(-1)[-1].flatten(0, -1),
+                    reduction="none",
+                )
                 rl_rew = -tca_ce.detach()
                 baseline_value = -torch.log(
                     torch.tensor(prediction.shape[-1])